@@ -142,13 +142,15 @@ graphics = '''\
 
 map_object = 'bntmx::map_object(bn::fixed_point({x}, {y}), {id}, {sprite_id})'
 
-objects_definition_template = '''\
+objects_definition_prefix = '''\
     // Objects are sorted by layers, then within layers they are sorted by
     // classes (with classless objects first), then within classes they are
     // sorted in the order they are found.
     // Because object IDs are assigned in the same order, they are also sorted
     // by ID.
-    static constexpr bntmx::map_object _objects[] = {objects};
+    static constexpr bntmx::map_object _objects[] = '''
+
+objects_definition_suffix = ''';
 
     // This purposefully doesn't use bn::span so we can use smaller types,
     // saving ROM space.
@@ -169,8 +171,28 @@ objects_getter_with_class = 'bn::span(&_objects[_objects_spans[objects_layer_ind
 
 objects_dummy = 'bn::span<const bntmx::map_object>()'
 
+tiles_layer_definition_prefix = '    static const bntmx::map_tile {name}[{size}] = '
+
+tiles_layer_definition_suffix = ''';
+
+'''
+
+tiles_layer_embed_definition = '''\
+    static const union
+    {{
+        uint8_t bytes[{size} * sizeof(bntmx::map_tile)];
+        bntmx::map_tile tiles[{size}];
+    }} {name} = {{{{
+#embed "{filename}"
+    }}}};
+
+'''
+
+tiles_layer_embed_pointer = '{name}.tiles'
+
 tiles_definition = '''\
-    static const bntmx::map_tile _tiles[{n_tiles_layers}][{size}] = {tiles};
+    // Identical tiles layers share the same array, saving ROM space.
+    static const bntmx::map_tile* const _tiles[{n_tiles_layers}] = {tiles_layers};
 '''
 
 tiles_getter = 'bn::span(_tiles[tiles_layer_index], {size})'
@@ -248,14 +270,15 @@ public:
 #endif
 '''
 
-source = '''\
+source_prefix = '''\
 #include "{header_filename}"
 
 namespace bntmx::maps
 {{
-{objects_definition}
+'''
+
+source_suffix = '''\
 
-{tiles_definition}
 
     const bntmx::map_object {map_name}::object(int id) const
     {{
@@ -294,14 +317,20 @@ template = {
     'object_dummy': object_dummy,
     'object_getter': object_getter,
     'objects_definition_empty': objects_definition_empty,
-    'objects_definition_template': objects_definition_template,
+    'objects_definition_prefix': objects_definition_prefix,
+    'objects_definition_suffix_template': objects_definition_suffix,
     'objects_dummy': objects_dummy,
     'objects_getter_classless': objects_getter_classless,
     'objects_getter_with_class': objects_getter_with_class,
-    'source_template': source,
+    'source_prefix_template': source_prefix,
+    'source_suffix_template': source_suffix,
     'tile_ids_definition_empty': tile_ids_definition_empty,
     'tile_ids_definition_template': tile_ids_definition_template,
     'tiles_definition_template': tiles_definition,
     'tiles_dummy': tiles_dummy,
+    'tiles_layer_embed_definition_template': tiles_layer_embed_definition,
+    'tiles_layer_embed_pointer_template': tiles_layer_embed_pointer,
+    'tiles_layer_definition_prefix_template': tiles_layer_definition_prefix,
+    'tiles_layer_definition_suffix': tiles_layer_definition_suffix,
     'tiles_getter_template': tiles_getter
 }
@@ -6,44 +6,91 @@ zlib License, see LICENSE file.
 from PIL import Image
 from tmx import TMX
 import argparse
+import array
+import concurrent.futures
+import functools
+import hashlib
 import json
+import logging
+import math
 import os
+import pathlib
 import re
+import sys
+import typing
 import bntemplate
 import ctemplate
 
+# orjson is optional, it only speeds up loading map descriptors
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
 _targets = ['butano', 'c']
 
+# Large outputs are written through big buffers to make few system calls
+_write_buffer_size = 1 << 20
+
 def write_to_file(filename: str, text: str):
-    f = open(filename, "w")
-    f.write(text)
-    f.close()
+    pathlib.Path(filename).write_text(text, encoding="utf-8", newline="\n")
 
-def inline_c_array(l: list) -> str:
+def multiline_c_array(l: list, indentation: str, depth: int) -> str:
     """
-    Return the inline C or C++ literal array or struct for the elements in the list.
+    Return the multiline C or C++ literal array or struct for the elements in the list.
+
+    The elements are expected to already be strings, so large arrays like tile
+    rows are joined as-is without being converted again.
 
-    :param l: the list of the array elements
-    :returns: the inline array literal
+    :param l: the list of the array element literals
+    :param indentation: the characters to use for an indentation level
+    :param depth: the depth of the indentation
+    :returns: the multiline array literal
     """
 
-    return "{" + ",".join(map(str, l)) + "}"
+    outer_indentation = indentation * depth
+    inner_indentation = indentation * (depth + 1)
+    splitter = ",\n" + inner_indentation
 
-def multiline_c_array(l: list, indentation: str, depth: int) -> str:
+    return "".join(("{\n", inner_indentation, splitter.join(l), "\n", outer_indentation, "}"))
+
+def write_multiline_c_array(f: typing.TextIO, l: typing.Iterable[str], indentation: str, depth: int):
     """
-    Return the multiline C or C++ literal array or struct for the elements in the list.
+    Write the multiline C or C++ literal array or struct for the elements in the
+    iterable to a file, one element at a time so the whole literal is never
+    held in memory.
 
-    :param l: the list of the array elements
+    :param f: the file to write to
+    :param l: the iterable of the array element literals
     :param indentation: the characters to use for an indentation level
     :param depth: the depth of the indentation
-    :returns: the multiline array literal
     """
 
     outer_indentation = indentation * depth
     inner_indentation = indentation * (depth + 1)
     splitter = ",\n" + inner_indentation
 
-    return "{\n" + inner_indentation + splitter.join(map(str, l)) + "\n" + outer_indentation + "}"
+    f.write("{\n" + inner_indentation)
+    for i, element in enumerate(l):
+        if i > 0:
+            f.write(splitter)
+        f.write(element)
+    f.write("\n" + outer_indentation + "}")
+
+def c_array_rows(l: list, width: int) -> typing.Iterator[str]:
+    """
+    Return the rows of comma-separated literals for the elements in the list,
+    to lay a large array out like a grid.
+
+    Rows are cut by zipping width references to the same iterator and joined in
+    a single call each, so no Python code runs per element.
+
+    :param l: the list of the array element literals
+    :param width: the number of elements per row
+    :returns: the row literals
+    """
+
+    return map(",".join, zip(*[iter(l)] * width))
 
 def bg_size(size: int):
     """
@@ -54,7 +101,97 @@ def bg_size(size: int):
     :returns: the size of the background that can fit the requested size
     """
 
-    return size if size % 256 == 0 else (size // 256 + 1) * 256
+    # assumes size >= 0
+    return (size + 255) & ~255
+
+def exact_paletted_image(image: Image.Image) -> typing.Optional[Image.Image]:
+    """
+    Return the paletted version of an image using its exact colors, which is
+    cheaper than quantizing it when it has few colors.
+
+    :param image: the RGBA image to convert
+    :returns: the paletted image, or None if the image has more than 256 colors
+    """
+
+    rgb_image = image.convert("RGB")
+    colors = rgb_image.getcolors(256)
+    if colors is None:
+        return None
+
+    palette_image = Image.new("P", (1, 1))
+    palette_image.putpalette(b"".join(bytes(color) for _, color in colors))
+    paletted = rgb_image.quantize(palette=palette_image, dither=Image.Dither.NONE)
+
+    # Mapping to a palette looks colors up by approximation, so very close
+    # colors can be merged into a single index, in which case median cut gives
+    # the exact colors.
+    if len(paletted.getcolors(256)) != len(colors):
+        paletted = rgb_image.quantize(len(colors), dither=Image.Dither.NONE)
+
+    return paletted
+
+def stack_images(images: typing.Iterable[Image.Image], size: tuple[int,int], n_images: int, background_color: str) -> Image.Image:
+    """
+    Return RGBA images of the same size stacked from top to bottom into a
+    single paletted image.
+
+    Each image is pasted as soon as it is produced, so images can be generated
+    one at a time without keeping them all in memory. Their exact colors are
+    kept as long as there are 256 of them or fewer, with the background color
+    first in the palette as it is the transparent one. Otherwise the stacked
+    image is quantized, which doesn't order its palette.
+
+    :param images: the RGBA images to stack
+    :param size: the width and height of each image
+    :param n_images: the number of images
+    :param background_color: the background color of the images
+    :returns: the stacked paletted image
+    """
+
+    background = Image.new("RGB", (1, 1), background_color).getpixel((0, 0))
+    colors = [background]
+    color_indices = {background: 0}
+
+    width, height = size
+    stacked = Image.new("L", (width, height * n_images))
+    images = iter(images)
+    for i, image in enumerate(images):
+        paletted = exact_paletted_image(image)
+        if paletted is None:
+            break
+
+        # Only add the colors of the image if they all fit in the shared palette
+        palette = paletted.getpalette()
+        image_colors = {index: tuple(palette[index * 3:index * 3 + 3]) for _, index in paletted.getcolors(256)}
+        new_colors = [color for color in dict.fromkeys(image_colors.values()) if color not in color_indices]
+        if len(colors) + len(new_colors) > 256:
+            break
+
+        for color in new_colors:
+            color_indices[color] = len(colors)
+            colors.append(color)
+
+        # Map the indices of the image's palette to the shared palette
+        lut = list(range(256))
+        for index, color in image_colors.items():
+            lut[index] = color_indices[color]
+
+        indices = Image.frombytes("L", paletted.size, paletted.tobytes()).point(lut)
+        stacked.paste(indices, (0, height * i))
+    else:
+        # Pad the palette to 256 colors as expected by importers of 8bpp BMP files
+        stacked.putpalette(b"".join(map(bytes, colors)).ljust(256 * 3, b"\0"))
+        return stacked
+
+    # There are too many colors to keep them all, so paste the images already
+    # stacked and the remaining ones into a single image and quantize it
+    stacked.putpalette(b"".join(map(bytes, colors)))
+    stacked = stacked.convert("RGBA")
+    stacked.paste(image, (0, height * i))
+    for i, image in enumerate(images, i + 1):
+        stacked.paste(image, (0, height * i))
+
+    return stacked.quantize(256)
 
 def mangle(name: str) -> str:
     """
@@ -78,58 +215,97 @@ class TMXConverter:
     def __init__(self, target, tmx_filename):
         assert target in _targets
 
+        # Only record the names here, the map is parsed on first use so maps
+        # that don't need to be rebuilt are cheap to check.
         self._target = target
-        self._tmx = TMX(tmx_filename)
+        self._tmx_filename = tmx_filename
         self._basename = os.path.splitext(os.path.basename(tmx_filename))[0]
         self._name = mangle(self._basename)
-        descriptor = open(os.path.splitext(tmx_filename)[0] + ".json")
-        self._descriptor = json.load(descriptor)
-        # Add empty lists so we don't ave to check their existence every time.
-        if "graphics" not in self._descriptor:
-            self._descriptor["graphics"] = []
-        if "objects" not in self._descriptor:
-            self._descriptor["objects"] = []
-        if "tiles" not in self._descriptor:
-            self._descriptor["tiles"] = []
 
+    @functools.cached_property
+    def _tmx(self):
+        return TMX(self._tmx_filename)
+
+    @functools.cached_property
+    def _descriptor(self):
+        descriptor = _json_loads(pathlib.Path(os.path.splitext(self._tmx_filename)[0] + ".json").read_bytes())
+        # Add empty lists so we don't ave to check their existence every time.
+        if "graphics" not in descriptor:
+            descriptor["graphics"] = []
+        if "objects" not in descriptor:
+            descriptor["objects"] = []
+        if "tiles" not in descriptor:
+            descriptor["tiles"] = []
+        return descriptor
+
+    @functools.cached_property
+    def _dimensions_in_pixels(self):
+        return self._tmx.dimensions_in_pixels()
+
+    @functools.cached_property
+    def _dimensions_in_tiles(self):
+        return self._tmx.dimensions_in_tiles()
+
+    @functools.cached_property
+    def _tile_dimensions(self):
+        return self._tmx.tile_dimensions()
+
+    @functools.cached_property
+    def _objects(self):
         # The list of MapObjects for the list of object layers
-        self._objects = list(map(lambda layer_path: self._tmx.objects(layer_path), self._descriptor["objects"] if "objects" in self._descriptor else []))
-        self._assign_id_and_layer_to_objects()
+        return list(map(lambda layer_path: self._tmx.objects(layer_path), self._descriptor["objects"] if "objects" in self._descriptor else []))
+
+    @functools.cached_property
+    def _objects_index(self):
+        # Assign IDs and layers to objects, and return the sorted object
+        # classes, the flat list of objects and the per-layer object spans so
+        # the object layers are walked only once per map.
 
-    def _assign_id_and_layer_to_objects(self):
-        object_classes = self._object_classes()
-        id = 0
+        layers_objects = [layer_map_objects.objects() for layer_map_objects in self._objects]
 
+        # The sorted set of map object class names in the whole map, including the "" class
+        # If there are no objects layers an empty list is returned, there is not even the "" class.
+        object_classes = sorted(set(map_object_class for objects in layers_objects for map_object_class in objects))
+
+        all_objects = []
+        spans = []
         # Layers are already sorted, let's first sort by layers
-        for layer_index, layer_map_objects in enumerate(self._objects):
-            objects = layer_map_objects.objects()
+        for layer_index, objects in enumerate(layers_objects):
+            layer_spans = []
 
             # Then sort by classes
             for object_class in object_classes:
-                if object_class not in objects:
-                    continue
+                index = len(all_objects)
 
                 # Then sort in whatever order the objects come in
-                for object in objects[object_class]:
+                for object in objects.get(object_class, ()):
                     object.map_layer = layer_index
-                    object.map_id = id
-                    id += 1
+                    object.map_id = len(all_objects)
+                    all_objects.append(object)
+
+                layer_spans.append((index, len(all_objects) - index))
+            spans.append(layer_spans)
+
+        return object_classes, all_objects, spans
 
     def _object_classes(self):
         # Return the sorted set of map object class names in the whole map, including the "" class
         # If there are no objects layers an empty list is returned, there is not even the "" class.
 
-        return sorted(set([map_object_class for layer_map_objects in self._objects for map_object_class in layer_map_objects.objects().keys()]))
+        object_classes, _, _ = self._objects_index
+        return object_classes
 
     def _object_classes_enum(self, namespace):
         # Return the list of enumeration definitions for the map object class names in the whole map, excluding the "" class
 
-        return list(map(lambda i_and_object_class: namespace + mangle(i_and_object_class[1]).upper() + "=" + str(i_and_object_class[0]), enumerate(self._object_classes())))[1:]
+        # The "" class always sorts first, skip it rather than building and dropping its definition
+        return [namespace + mangle(object_class).upper() + "=" + str(i) for i, object_class in enumerate(self._object_classes()[1:], 1)]
 
     def _all_objects(self):
-        # Return the list of map objects in the whole map
+        # Return the list of map objects in the whole map, sorted by ID
 
-        return sorted([map_object for layer_map_objects in self._objects for _, map_objects in layer_map_objects.objects().items() for map_object in map_objects], key=lambda o: o.map_id)
+        _, all_objects, _ = self._objects_index
+        return all_objects
 
     def _object_ids_enum(self, namespace):
         # Return the list of enumeration definitions for the map object ids in the whole map, excluding the None ids
@@ -151,17 +327,8 @@ class TMXConverter:
         # object of a given class in the layer, so objects can be flattened but
         # they can still be found per layer and class.
 
-        index_lengths = []
-        index = 0
-        object_classes = self._object_classes()
-        for layer in self._objects:
-            layer_index_lengths = []
-            for object_class in object_classes:
-                length = len(layer.objects()[object_class]) if object_class in layer.objects() else 0
-                layer_index_lengths.append((index, length))
-                index = index + length
-            index_lengths.append(layer_index_lengths)
-        return index_lengths
+        _, _, spans = self._objects_index
+        return spans
 
     def dependencies(self):
         return self._tmx.dependencies()
@@ -183,25 +350,27 @@ class TMXConverter:
             return None
 
         # The size of the map, in pixels
-        src_width, src_height = self._tmx.dimensions_in_pixels()
+        src_width, src_height = self._dimensions_in_pixels
         # The size of each individual background
         bg_width, bg_height = bg_size(src_width), bg_size(src_height)
 
-        # Compose the layers into a single background image
+        background_color = self._tmx.background_color()
         n_layers = len(self._descriptor["graphics"])
-        gfx_im = Image.new("RGBA", (bg_width, bg_height * n_layers), self._tmx.background_color())
-        for i, layer_path in enumerate(self._descriptor["graphics"]):
-            self._tmx.compose(gfx_im, layer_path, 0, bg_height * i)
 
-        # Make the image paletted
-        gfx_im = gfx_im.quantize(256)
+        # Compose the layers one by one and paste them right away, so only a
+        # single RGBA layer is held at once unless they need to be quantized
+        def layers_images():
+            for layer_path in self._descriptor["graphics"]:
+                layer_im = Image.new("RGBA", (bg_width, bg_height), background_color)
+                self._tmx.compose(layer_im, layer_path, 0, 0)
+                yield layer_im
 
-        return gfx_im
+        return stack_images(layers_images(), (bg_width, bg_height), n_layers, background_color)
 
     def regular_bg_descriptor(self):
         # Convert the TMX into its regular background descriptor.
 
-        _, src_height = self._tmx.dimensions_in_pixels()
+        _, src_height = self._dimensions_in_pixels
         bg_height = bg_size(src_height)
 
         return bntemplate.graphics.format(bg_height=bg_height)
@@ -228,9 +397,9 @@ class TMXConverter:
             template = ctemplate.template
 
         guard = "BNTMX_MAPS_" + self._name.upper() + "_H"
-        width_in_pixels, height_in_pixels = self._tmx.dimensions_in_pixels()
-        width_in_tiles, height_in_tiles = self._tmx.dimensions_in_tiles()
-        tile_width, tile_height = self._tmx.tile_dimensions()
+        width_in_pixels, height_in_pixels = self._dimensions_in_pixels
+        width_in_tiles, height_in_tiles = self._dimensions_in_tiles
+        tile_width, tile_height = self._tile_dimensions
         objects = self._objects
 
         object_classes = self._object_classes_enum(namespace)
@@ -273,8 +442,11 @@ class TMXConverter:
             width_in_pixels=width_in_pixels,
             width_in_tiles=width_in_tiles)
 
-    def butano_source(self):
-        # Convert the TMX into its C++ source.
+    def write_butano_source(self, f: typing.TextIO, embed_dir: typing.Optional[str] = None):
+        # Write the C++ source of the TMX to a file. If embed_dir is set, the
+        # tiles layers are written as binary files in it and included with
+        # #embed instead of being written as array literals. Return the paths
+        # of the binary files.
 
         indentation = "    "
         if self._target == "butano":
@@ -288,53 +460,102 @@ class TMXConverter:
 
         header_filename = "bntmx_maps_" + self._name + ".h"
 
-        width_in_tiles, height_in_tiles = self._tmx.dimensions_in_tiles()
+        width_in_tiles, height_in_tiles = self._dimensions_in_tiles
         n_graphics_layers = len(self._descriptor["graphics"]) if "graphics" in self._descriptor else 0
         n_objects_layers = len(self._descriptor["objects"]) if "objects" in self._descriptor else 0
         n_tiles_layers = len(self._descriptor["tiles"]) if "tiles" in self._descriptor else 0
         size = width_in_tiles * height_in_tiles
 
         n_objects_classes = len(self._object_classes())
-        objects_spans = multiline_c_array(map(lambda layer: multiline_c_array(map(inline_c_array, layer), indentation, indentation_depth + 1), self._object_spans()), indentation, indentation_depth)
+        # Get the C or C++ struct literal of an (index,length) span, formatted in a single operation.
+        span_to_literal = "{%d,%d}".__mod__
         objects = self._all_objects()
         n_objects = len(objects)
         object_to_cpp_literal = lambda o: template['map_object_template'].format(x=o.x, y=o.y, id=o.map_id if o.id is None else namespace + str(o.id), sprite_id=o.sprite_id)
-        objects_literal = multiline_c_array(list(map(object_to_cpp_literal, objects)), indentation, indentation_depth)
 
-        # Get the C or C++ array literal for the given list of tiles, matching lines and columns of the map for readability.
-        tiles_to_array_literal = lambda tiles: multiline_c_array([",".join(tiles[i:i + width_in_tiles]) for i in range(0, len(tiles), width_in_tiles)], indentation, indentation_depth + 1)
-        # Get the C or C++ array literal of tiles for the given tiles layer path.
-        tiles_layer_path_to_array_literal = lambda layer_path: tiles_to_array_literal(self._tmx.tiles(layer_path))
-        # Get the C or C++ array literal of tiles layers for the given tiles layer paths.
-        tiles_literal = multiline_c_array(list(map(tiles_layer_path_to_array_literal, self._descriptor["tiles"] if "tiles" in self._descriptor else [])), indentation, indentation_depth)
+        # The paths of the binary files written by write_tiles_definition()
+        bin_paths = []
+
+        def write_tiles_definition():
+            # Write the tiles layers one at a time. Identical layers are written
+            # only once and share the same array.
+            layers_pointers = []
+            digests_pointers = {}
+            for layer_path in self._descriptor["tiles"]:
+                tiles = self._tmx.tiles(layer_path)
+                digest = hashlib.blake2b(",".join(tiles).encode()).digest()
+                if digest not in digests_pointers:
+                    name = "_tiles_" + str(len(digests_pointers))
+                    if embed_dir is None:
+                        digests_pointers[digest] = name
+                        f.write(template['tiles_layer_definition_prefix_template'].format(
+                            name=name,
+                            size=size))
+                        # Write the tiles row by row, matching lines and columns of the map for readability.
+                        write_multiline_c_array(f, c_array_rows(tiles, width_in_tiles), indentation, indentation_depth)
+                        f.write(template['tiles_layer_definition_suffix'])
+                    else:
+                        # Map tiles are little-endian 16 bits integers
+                        bin_filename = "bntmx_maps_" + self._name + name + ".bin"
+                        tiles_array = array.array("H", map(int, tiles))
+                        if sys.byteorder == "big":
+                            tiles_array.byteswap()
+                        bin_path = os.path.join(embed_dir, bin_filename)
+                        with open(bin_path, "wb") as bin_file:
+                            tiles_array.tofile(bin_file)
+                        bin_paths.append(bin_path)
+                        digests_pointers[digest] = template['tiles_layer_embed_pointer_template'].format(name=name)
+                        f.write(template['tiles_layer_embed_definition_template'].format(
+                            filename=bin_filename,
+                            name=name,
+                            size=size))
+                layers_pointers.append(digests_pointers[digest])
+
+            f.write(template['tiles_definition_template'].format(
+                n_tiles_layers=n_tiles_layers,
+                tiles_layers=multiline_c_array(layers_pointers, indentation, indentation_depth)))
 
-        if n_objects == 0 or n_objects_classes == 0 or n_objects_layers == 0:
-            object_getter = template['object_dummy']
-            objects_definition = template['objects_definition_empty']
-            objects_getter_classless = template['objects_dummy']
-            objects_getter_with_class = template['objects_dummy']
-        else:
-            object_getter = template['object_getter']
-            objects_definition = template['objects_definition_template'].format(
+        def write_objects_definition():
+            # Write the objects one at a time, then their spans.
+            f.write(template['objects_definition_prefix'])
+            write_multiline_c_array(f, map(object_to_cpp_literal, objects), indentation, indentation_depth)
+            f.write(template['objects_definition_suffix_template'].format(
                 n_objects_classes=n_objects_classes,
                 n_objects_layers=n_objects_layers,
-                objects=objects_literal,
-                objects_spans=objects_spans)
+                objects_spans=multiline_c_array(map(lambda layer: multiline_c_array(map(span_to_literal, layer), indentation, indentation_depth + 1), self._object_spans()), indentation, indentation_depth)))
+
+        has_objects = n_objects != 0 and n_objects_classes != 0 and n_objects_layers != 0
+        if has_objects:
+            object_getter = template['object_getter']
             objects_getter_classless = template['objects_getter_classless']
             objects_getter_with_class = template['objects_getter_with_class']
+        else:
+            object_getter = template['object_dummy']
+            objects_getter_classless = template['objects_dummy']
+            objects_getter_with_class = template['objects_dummy']
 
-        if size == 0 or n_tiles_layers == 0:
-            tiles_definition = ''
+        has_tiles = size != 0 and n_tiles_layers != 0
+        if has_tiles:
+            tiles_getter = template['tiles_getter_template'].format(size=size)
+        else:
             tiles_getter = template['tiles_dummy']
+
+        # The objects and the tiles are the bulk of the source, so they are
+        # written directly to the file between the parts of the source template.
+        f.write(template['source_prefix_template'].format(
+            header_filename=os.path.basename(header_filename)))
+
+        if has_objects:
+            write_objects_definition()
         else:
-            tiles_definition = template['tiles_definition_template'].format(
-                n_tiles_layers=n_tiles_layers,
-                size=size,
-                tiles=tiles_literal)
-            tiles_getter = template['tiles_getter_template'].format(size=size)
+            f.write(template['objects_definition_empty'])
+
+        f.write("\n\n")
 
-        return template['source_template'].format(
-            header_filename=os.path.basename(header_filename),
+        if has_tiles:
+            write_tiles_definition()
+
+        f.write(template['source_suffix_template'].format(
             map_name=self._name,
             n_objects_classes=n_objects_classes,
             n_objects_layers=n_objects_layers,
@@ -343,27 +564,141 @@ class TMXConverter:
             object_getter=object_getter,
             objects_getter_classless=objects_getter_classless,
             objects_getter_with_class=objects_getter_with_class,
-            objects_definition=objects_definition,
-            size=size,
-            tiles_definition=tiles_definition,
-            tiles_getter=tiles_getter,
-            tiles=tiles_literal)
+            tiles_getter=tiles_getter))
+
+        return bin_paths
+
+def _files_mtimes(directory: str) -> dict[str,float]:
+    """
+    Return the modification times of the files in a directory. Every file of the
+    directory is stat once, but scanning it saves checking whether each file
+    exists and looking the same file up again for every map depending on it.
 
-def process(target, maps_dirs, build_dir):
+    :param directory: the path to the directory
+    :returns: the modification times of the files by file name
+    """
+
+    with os.scandir(directory) as entries:
+        return {entry.name: entry.stat().st_mtime for entry in entries if entry.is_file()}
+
+def _mtime(mtimes: dict[str,dict[str,float]], filename: str) -> float:
+    """
+    Return the modification time of a file, or 0 if it doesn't exist. Files in
+    scanned directories are looked up without accessing the file system.
+
+    :param mtimes: the modification times of the files by scanned directory
+    :param filename: the path to the file
+    :returns: the modification time of the file
+    """
+
+    directory, name = os.path.split(filename)
+    if directory in mtimes:
+        return mtimes[directory].get(name, 0)
+    return os.path.getmtime(filename) if os.path.isfile(filename) else 0
+
+def _map_filenames(target, tmx_filename, build_dir):
+    # Return the paths of the input descriptor and of the outputs of a map, by
+    # kind of file, without parsing the map.
+
+    map_basename = os.path.splitext(os.path.basename(tmx_filename))[0]
+    map_name = mangle(map_basename)
+
+    filenames = {
+        "tmx_json": os.path.join(os.path.dirname(tmx_filename), map_basename + ".json"),
+        "bmp": os.path.join(build_dir, "graphics", map_name + ".bmp"),
+        "bmp_json": os.path.join(build_dir, "graphics", map_name + ".json"),
+        "header": os.path.join(build_dir, "include", "bntmx_maps_" + map_name + ".h"),
+        "deps": os.path.join(build_dir, "bntmx_maps_" + map_name + ".deps"),
+    }
+    if target == "butano":
+        filenames["source"] = os.path.join(build_dir, "src", "bntmx_maps_" + map_name + ".cpp")
+    elif target == "c":
+        filenames["source"] = os.path.join(build_dir, "src", "bntmx_maps_" + map_name + ".c")
+
+    return filenames
+
+def _is_map_up_to_date(target, tmx_filename, build_dir, mtimes, embed):
+    # Return whether the outputs of a map are newer than its inputs. The
+    # dependencies and the binary files of the map are read from the previous
+    # build so we don't have to parse the map to know them. A build with a
+    # different embed setting is out of date, and so is a build with missing
+    # inputs as they may have been moved.
+
+    filenames = _map_filenames(target, tmx_filename, build_dir)
+    if _mtime(mtimes, filenames["deps"]) == 0:
+        return False
+
+    try:
+        with open(filenames["deps"], "rb") as deps_file:
+            deps = _json_loads(deps_file.read())
+        if deps["embed"] != embed:
+            return False
+        maps_dir = os.path.dirname(tmx_filename)
+        dependencies = [os.path.normpath(os.path.join(maps_dir, dependency)) for dependency in deps["dependencies"]]
+        input_mtime = max(map(lambda filename : _mtime(mtimes, filename) or math.inf, [tmx_filename, filenames["tmx_json"]] + dependencies))
+        bin_filenames = [os.path.join(build_dir, bin_filename) for bin_filename in deps["binaries"]]
+        output_mtime = min(map(lambda filename : _mtime(mtimes, filename), [filenames["bmp"], filenames["bmp_json"], filenames["header"], filenames["source"], filenames["deps"]] + bin_filenames))
+    except (ValueError, KeyError, TypeError):
+        return False
+
+    return input_mtime < output_mtime
+
+def _process_map(target, tmx_filename, build_dir, embed):
+    # Convert a single map, this can run in its own worker process.
+
+    converter = TMXConverter(target, tmx_filename)
+    filenames = _map_filenames(target, tmx_filename, build_dir)
+
+    # The binary files of the previous build are removed if they aren't written
+    # again, e.g. when the embed setting is turned off
+    previous_bin_filenames = []
+    try:
+        with open(filenames["deps"], "rb") as deps_file:
+            previous_bin_filenames = [os.path.join(build_dir, bin_filename) for bin_filename in _json_loads(deps_file.read())["binaries"]]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    # Export the image
+    gfx_im = converter.regular_bg_image()
+    if gfx_im is not None:
+        with open(filenames["bmp"], "wb", buffering=_write_buffer_size) as f:
+            gfx_im.save(f, "BMP")
+        # Export the graphics descriptor
+        if target == "butano":
+            write_to_file(filenames["bmp_json"], converter.regular_bg_descriptor())
+
+    # Export the C++ header
+    write_to_file(filenames["header"], converter.butano_header())
+
+    # Export the C++ source
+    with open(filenames["source"], "w", buffering=_write_buffer_size, encoding="utf-8", newline="\n") as f:
+        bin_filenames = converter.write_butano_source(f, os.path.join(build_dir, "include") if embed else None)
+
+    for bin_filename in set(previous_bin_filenames) - set(bin_filenames):
+        try:
+            os.remove(bin_filename)
+        except FileNotFoundError:
+            pass
+
+    # Export the dependencies last, so they are only up to date if the whole map
+    # is. They are relative to the maps directory and the binary files to the
+    # build directory, so these can be moved.
+    maps_dir = os.path.dirname(tmx_filename)
+    write_to_file(filenames["deps"], json.dumps({
+        "embed": embed,
+        "dependencies": [os.path.relpath(dependency, maps_dir) for dependency in converter.dependencies()],
+        "binaries": [os.path.relpath(bin_filename, build_dir) for bin_filename in bin_filenames]}, indent=4))
+
+def process(target, maps_dirs, build_dir, embed=False):
     assert target in _targets
 
     build_graphics_dir = os.path.join(build_dir, "graphics")
     build_include_dir = os.path.join(build_dir, "include")
     build_src_dir = os.path.join(build_dir, "src")
 
-    if not os.path.exists(build_dir):
-        os.makedirs(build_dir)
-    if not os.path.exists(build_graphics_dir):
-        os.makedirs(build_graphics_dir)
-    if not os.path.exists(build_include_dir):
-        os.makedirs(build_include_dir)
-    if not os.path.exists(build_src_dir):
-        os.makedirs(build_src_dir)
+    # The build directory itself is created as their parent
+    for directory in [build_graphics_dir, build_include_dir, build_src_dir]:
+        pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
 
     # Export the global header
     include_filename = os.path.join(build_dir, "include", "bntmx.h")
@@ -373,48 +708,51 @@ def process(target, maps_dirs, build_dir):
         include = ctemplate.include
     write_to_file(include_filename, include)
 
+    # Scan the modification times of the maps and their outputs once for all
+    # maps. Paths are resolved so they match the ones of the dependencies.
+    mtimes = {}
+    tmx_filenames = []
     for maps_dir in maps_dirs:
-        for map_file in os.listdir(maps_dir):
-            if map_file.endswith('.tmx') and os.path.isfile(os.path.join(maps_dir, map_file)):
-                tmx_filename = os.path.join(maps_dir, map_file)
-                converter = TMXConverter(target, tmx_filename)
-                map_basename = converter.basename()
-                map_name = converter.name()
-
-                tmx_json_filename = os.path.join(maps_dir, map_basename + ".json")
-                bmp_filename = os.path.join(build_dir, "graphics", map_name + ".bmp")
-                bmp_json_filename = os.path.join(build_dir, "graphics", map_name + ".json")
-                header_filename = os.path.join(build_dir, "include", "bntmx_maps_" + map_name + ".h")
-                if target == "butano":
-                    source_filename = os.path.join(build_dir, "src", "bntmx_maps_" + map_name + ".cpp")
-                elif target == "c":
-                    source_filename = os.path.join(build_dir, "src", "bntmx_maps_" + map_name + ".c")
-
-                # Don't rebuild unchanged files
-                input_mtime = max(map(lambda filename : os.path.getmtime(filename) if os.path.isfile(filename) else 0, [tmx_filename, tmx_json_filename] + converter.dependencies()))
-                output_mtime = min(map(lambda filename : os.path.getmtime(filename) if os.path.isfile(filename) else 0, [bmp_filename, bmp_json_filename, header_filename, source_filename]))
-                if input_mtime < output_mtime:
-                    continue
-
-                # Export the image
-                gfx_im = converter.regular_bg_image()
-                if gfx_im is not None:
-                    gfx_im.save(bmp_filename, "BMP")
-                    # Export the graphics descriptor
-                    if target == "butano":
-                        write_to_file(bmp_json_filename, converter.regular_bg_descriptor())
-
-                # Export the C++ header
-                write_to_file(header_filename, converter.butano_header())
-
-                # Export the C++ source
-                write_to_file(source_filename, converter.butano_source())
+        maps_dir = os.path.realpath(maps_dir)
+        mtimes[maps_dir] = _files_mtimes(maps_dir)
+        tmx_filenames += [os.path.join(maps_dir, map_file) for map_file in mtimes[maps_dir] if map_file.endswith('.tmx')]
+    build_dir = os.path.realpath(build_dir)
+    for directory in [build_dir, os.path.join(build_dir, "graphics"), os.path.join(build_dir, "include"), os.path.join(build_dir, "src")]:
+        mtimes[directory] = _files_mtimes(directory)
+
+    # Maps are converted in parallel, so make sure no two jobs write the same
+    # outputs. The same map can be listed twice when a maps directory is given
+    # twice, but different maps must not have the same mangled name.
+    maps_tmx_filenames = {}
+    for tmx_filename in tmx_filenames:
+        map_name = mangle(os.path.splitext(os.path.basename(tmx_filename))[0])
+        if map_name not in maps_tmx_filenames:
+            maps_tmx_filenames[map_name] = tmx_filename
+        elif maps_tmx_filenames[map_name] != tmx_filename:
+            logging.critical(tmx_filename + ": Map name " + map_name + " already used by " + maps_tmx_filenames[map_name])
+            exit(1)
+    tmx_filenames = list(maps_tmx_filenames.values())
+
+    # Don't rebuild unchanged maps, they are checked before starting any job so
+    # a build with nothing to do stays cheap
+    tmx_filenames = [tmx_filename for tmx_filename in tmx_filenames if not _is_map_up_to_date(target, tmx_filename, build_dir, mtimes, embed)]
+    if len(tmx_filenames) <= 1:
+        for tmx_filename in tmx_filenames:
+            _process_map(target, tmx_filename, build_dir, embed)
+        return
+
+    # Maps are independent from each other, so convert them in parallel
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        futures = [executor.submit(_process_map, target, tmx_filename, build_dir, embed) for tmx_filename in tmx_filenames]
+        for future in futures:
+            future.result()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Compile Tiled maps into code and data usable by the game engine.')
     parser.add_argument('--target', choices=_targets, required=True, help='build target')
     parser.add_argument('--build', required=True, help='build directory path')
+    parser.add_argument('--embed', action='store_true', help='store tiles in binary files included with #embed')
     parser.add_argument('mapsdirs', metavar='mapsdir', nargs='+',
                         help='maps directories paths')
     args = parser.parse_args()
-    process(args.target, args.mapsdirs, args.build)
+    process(args.target, args.mapsdirs, args.build, args.embed)
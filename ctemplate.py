@@ -36,14 +36,16 @@ typedef struct
 
 map_object = '(bntmx_map_object) {{{x}, {y}, {id}}}'
 
-objects_definition_template = '''\
+objects_definition_prefix = '''\
 /* Objects are sorted by layers, then within layers they are sorted by classes
  * (with classless objects first), then within classes they are sorted in the
  * order they are found.
  * Because object IDs are assigned in the same order, they are also sorted by
  * ID.
  */
-static const bntmx_map_object _objects[] = {objects};
+static const bntmx_map_object _objects[] = '''
+
+objects_definition_suffix = ''';
 
 /* This purposefully doesn't use bntmx_span so we can use smaller types, saving
  * ROM space.
@@ -63,8 +65,28 @@ objects_getter = '(bntmx_span) {&_objects[_objects_spans[objects_layer_index][ob
 
 objects_dummy = '(bntmx_span) {NULL, 0}'
 
+tiles_layer_definition_prefix = 'static const bntmx_map_tile {name}[{size}] = '
+
+tiles_layer_definition_suffix = ''';
+
+'''
+
+tiles_layer_embed_definition = '''\
+static const union
+{{
+    unsigned char bytes[{size} * sizeof(bntmx_map_tile)];
+    bntmx_map_tile tiles[{size}];
+}} {name} = {{{{
+#embed "{filename}"
+}}}};
+
+'''
+
+tiles_layer_embed_pointer = '{name}.tiles'
+
 tiles_definition = '''\
-static const bntmx_map_tile _tiles[{n_tiles_layers}][{size}] = {tiles};
+/* Identical tiles layers share the same array, saving ROM space. */
+static const bntmx_map_tile* const _tiles[{n_tiles_layers}] = {tiles_layers};
 '''
 
 tiles_getter = '(bntmx_span) {{_tiles[tiles_layer_index], {size}}}'
@@ -120,14 +142,15 @@ const bntmx_span bntmx_maps_{map_name}_tiles(int tiles_layer_index);
 #endif
 '''
 
-source = '''\
+source_prefix = '''\
 #include "{header_filename}"
 
 #include <assert.h>
 
-{objects_definition}
+'''
+
+source_suffix = '''\
 
-{tiles_definition}
 
 const bntmx_map_object bntmx_maps_{map_name}_object(int id)
 {{
@@ -159,14 +182,20 @@ template = {
     'object_dummy': object_dummy,
     'object_getter': object_getter,
     'objects_definition_empty': objects_definition_empty,
-    'objects_definition_template': objects_definition_template,
+    'objects_definition_prefix': objects_definition_prefix,
+    'objects_definition_suffix_template': objects_definition_suffix,
     'objects_dummy': objects_dummy,
     'objects_getter_classless': objects_getter,
     'objects_getter_with_class': objects_getter,
-    'source_template': source,
+    'source_prefix_template': source_prefix,
+    'source_suffix_template': source_suffix,
     'tile_ids_definition_empty': tile_ids_definition_empty,
     'tile_ids_definition_template': tile_ids_definition_template,
     'tiles_definition_template': tiles_definition,
     'tiles_dummy': tiles_dummy,
+    'tiles_layer_embed_definition_template': tiles_layer_embed_definition,
+    'tiles_layer_embed_pointer_template': tiles_layer_embed_pointer,
+    'tiles_layer_definition_prefix_template': tiles_layer_definition_prefix,
+    'tiles_layer_definition_suffix': tiles_layer_definition_suffix,
     'tiles_getter_template': tiles_getter
 }
@@ -19,7 +19,8 @@ def _bg_size(size: int):
     :returns: the size of the background that can fit the requested size
     """
 
-    return size if size % 256 == 0 else (size // 256 + 1) * 256
+    # assumes size >= 0
+    return (size + 255) & ~255
 
 def _object_position(object_node: ET.Element) -> tuple[int,int]:
     """